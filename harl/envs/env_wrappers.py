@@ -6,9 +6,14 @@ import numpy as np
 import torch
 import gym
 import gymnasium
-from multiprocessing import Process, Pipe
+from multiprocessing import Process, Pipe, resource_tracker, shared_memory
+from multiprocessing.connection import wait
 from abc import ABC, abstractmethod
 import copy
+import functools
+import gc
+import os
+import pickle
 from typing import Any, Mapping, Sequence, Tuple, Union
 
 
@@ -27,9 +32,11 @@ def tile_images(img_nhwc):
     N, h, w, c = img_nhwc.shape
     H = int(np.ceil(np.sqrt(N)))
     W = int(np.ceil(float(N) / H))
-    img_nhwc = np.array(list(img_nhwc) + [img_nhwc[0] * 0 for _ in range(N, H * W)])
-    img_HWhwc = img_nhwc.reshape(H, W, h, w, c)
-    img_HhWwc = img_HWhwc.transpose(0, 2, 1, 3, 4)
+    # pad with blank images in one preallocated buffer instead of a list of copies
+    canvas = np.zeros((H * W, h, w, c), dtype=img_nhwc.dtype)
+    canvas[:N] = img_nhwc
+    img_HWhwc = canvas.reshape(H, W, h, w, c)
+    img_HhWwc = img_HWhwc.swapaxes(1, 2)
     img_Hh_Ww_c = img_HhWwc.reshape(H * h, W * w, c)
     return img_Hh_Ww_c
 
@@ -53,6 +60,47 @@ class CloudpickleWrapper(object):
         self.x = pickle.loads(ob)
 
 
+class PipePairConnection(object):
+    """
+    Duplex connection made of two one-way pipes, which are plain os.pipe() on POSIX
+    instead of the socketpair behind Pipe(duplex=True).
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, obj):
+        self.writer.send(obj)
+
+    def send_bytes(self, buf):
+        self.writer.send_bytes(buf)
+
+    def recv(self):
+        return self.reader.recv()
+
+    def recv_bytes(self):
+        return self.reader.recv_bytes()
+
+    def fileno(self):
+        # lets multiprocessing.connection.wait() poll for incoming messages
+        return self.reader.fileno()
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+def pipe_pair():
+    """Return the two ends of a PipePairConnection, like Pipe()."""
+    cmd_reader, cmd_writer = Pipe(duplex=False)
+    result_reader, result_writer = Pipe(duplex=False)
+    return (
+        PipePairConnection(result_reader, cmd_writer),
+        PipePairConnection(cmd_reader, result_writer),
+    )
+
+
 class ShareVecEnv(ABC):
     """
     An abstract asynchronous, vectorized environment.
@@ -168,34 +216,118 @@ class ShareVecEnv(ABC):
         return self.viewer
 
 
-def shareworker(remote, parent_remote, env_fn_wrapper):
+# fields returned by env.step() and env.reset(), in order
+STEP_FIELDS = ("obs", "share_obs", "rews", "dones", "infos", "available_actions")
+RESET_FIELDS = ("obs", "share_obs", "available_actions")
+# fields batched with a fixed dtype, the others take theirs from the env's values
+FIELD_DTYPES = {"rews": np.float32, "dones": np.bool_}
+# single-byte messages for the commands that carry no pickled data, the others are
+# sent as pickled (cmd, data) tuples; "step" means the actions wait in shared memory
+COMMAND_TOKENS = {
+    "step": b"\x01",
+    "reset": b"\x02",
+    "reset_task": b"\x03",
+    "close": b"\x04",
+    "get_spaces": b"\x05",
+    "get_num_agents": b"\x06",
+}
+TOKEN_COMMANDS = {token: cmd for cmd, token in COMMAND_TOKENS.items()}
+
+
+def write_shared_fields(results, fields, shm_views):
+    """Write the fields that live in shared memory into their slabs in place and
+    drop them from the message, so that only the remaining fields are pickled.
+    A value its slab's dtype cannot hold is left in the message instead."""
+    if not shm_views:
+        return results
+    results = list(results)
+    for i, field in enumerate(fields):
+        view = shm_views.get(field)
+        if view is not None and (field in FIELD_DTYPES or can_hold(view.dtype, results[i])):
+            view[...] = results[i]
+            results[i] = None
+    return tuple(results)
+
+
+def can_hold(dtype, value):
+    """Whether value can be written into an array of dtype without losing anything."""
+    return dtype.kind == "O" or np.can_cast(np.result_type(value), dtype)
+
+
+def fast_copy(x):
+    """Copy an observation-like structure, using ndarray.copy() on the array leaves
+    rather than copy.deepcopy, which walks them through the generic deepcopy machinery.
+    Immutable leaves (e.g. the None available actions of continuous envs) are shared."""
+    if isinstance(x, np.ndarray):
+        return x.copy()
+    if x is None or isinstance(x, (bool, int, float, str, np.generic)):
+        return x
+    if isinstance(x, torch.Tensor):
+        return x.clone()
+    if isinstance(x, dict):
+        return {k: fast_copy(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(fast_copy(v) for v in x)
+    return copy.deepcopy(x)
+
+
+# with a gc_interval, workers collecting young objects every gc_interval steps also
+# collect the older generations every GC_FULL_FACTOR * gc_interval steps
+GC_FULL_FACTOR = 100
+
+
+def shareworker(remote, parent_remote, env_fn_wrapper, cpu_index=None, gc_interval=None):
     parent_remote.close()
+    if cpu_index is not None and hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[cpu_index % len(cpus)]})
+    if gc_interval is not None:
+        gc.disable()
     env = env_fn_wrapper.x()
+    if gc_interval is not None:
+        gc.freeze()  # the env and imported modules live for the whole run; keep them out of collections
+    shm_handles = []
+    shm_views = {}
+    n_steps = 0
     while True:
-        cmd, data = remote.recv()
+        msg = remote.recv_bytes()
+        if msg in TOKEN_COMMANDS:
+            cmd, data = TOKEN_COMMANDS[msg], None
+            if cmd == "step":
+                # copy so that the env may keep or modify its actions
+                data = shm_views["actions"].copy()
+        else:
+            cmd, data = pickle.loads(msg)
         if cmd == "step":
             ob, s_ob, reward, done, info, available_actions = env.step(data)
-            if "bool" in done.__class__.__name__:  # done is a bool
-                if (
-                    done
-                ):  # if done, save the original obs, state, and available actions in info, and then reset
-                    info[0]["original_obs"] = copy.deepcopy(ob)
-                    info[0]["original_state"] = copy.deepcopy(s_ob)
-                    info[0]["original_avail_actions"] = copy.deepcopy(available_actions)
-                    ob, s_ob, available_actions = env.reset()
-            else:
-                if np.all(
-                    done
-                ):  # if done, save the original obs, state, and available actions in info, and then reset
-                    info[0]["original_obs"] = copy.deepcopy(ob)
-                    info[0]["original_state"] = copy.deepcopy(s_ob)
-                    info[0]["original_avail_actions"] = copy.deepcopy(available_actions)
-                    ob, s_ob, available_actions = env.reset()
-
-            remote.send((ob, s_ob, reward, done, info, available_actions))
+            n_steps += 1
+            if np.all(
+                done
+            ):  # if done (a bool, or all agents done), save the original obs, state, and available actions in info, and then reset
+                info[0]["original_obs"] = fast_copy(ob)
+                info[0]["original_state"] = fast_copy(s_ob)
+                info[0]["original_avail_actions"] = fast_copy(available_actions)
+                ob, s_ob, available_actions = env.reset()
+            if gc_interval is not None:
+                if n_steps % (GC_FULL_FACTOR * gc_interval) == 0:
+                    gc.collect()
+                elif n_steps % gc_interval == 0:
+                    gc.collect(0)
+
+            remote.send(
+                write_shared_fields(
+                    (ob, s_ob, reward, done, info, available_actions),
+                    STEP_FIELDS,
+                    shm_views,
+                )
+            )
         elif cmd == "reset":
             ob, s_ob, available_actions = env.reset()
-            remote.send((ob, s_ob, available_actions))
+            remote.send(
+                write_shared_fields(
+                    (ob, s_ob, available_actions), RESET_FIELDS, shm_views
+                )
+            )
         elif cmd == "reset_task":
             ob = env.reset_task()
             remote.send(ob)
@@ -207,6 +339,8 @@ def shareworker(remote, parent_remote, env_fn_wrapper):
                 env.render(mode=data)
         elif cmd == "close":
             env.close()
+            for shm in shm_handles:
+                shm.close()
             remote.close()
             break
         elif cmd == "get_spaces":
@@ -218,26 +352,49 @@ def shareworker(remote, parent_remote, env_fn_wrapper):
             remote.send((fr))
         elif cmd == "get_num_agents":
             remote.send((env.n_agents))
+        elif cmd == "attach_shared_memory":
+            # view this env's row of each (n_envs, ...) slab allocated by the parent
+            index, specs = data
+            for field, name, shape, dtype in specs:
+                shm = shared_memory.SharedMemory(name=name)
+                shm_handles.append(shm)
+                # [index, ...] keeps a (possibly 0-d) view where [index] would
+                # return a copied scalar for per-env scalars such as a bool done
+                shm_views[field] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[
+                    index, ...
+                ]
         else:
             raise NotImplementedError
 
 
 class ShareSubprocVecEnv(ShareVecEnv):
-    def __init__(self, env_fns, spaces=None):
+    def __init__(self, env_fns, spaces=None, pin_workers=False, gc_interval=None):
         """
         envs: list of gym environments to run in subprocesses
+        pin_workers: pin each worker to its own CPU (Linux only) to cut scheduling jitter
+        gc_interval: if given, turn off automatic gc in the workers and collect young objects
+            every gc_interval steps instead (and everything every GC_FULL_FACTOR * gc_interval steps)
         """
         self.waiting = False
         self.closed = False
         nenvs = len(env_fns)
-        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
+        # start the tracker before forking so that the workers attaching to the
+        # shared memory below register with ours instead of spawning their own
+        resource_tracker.ensure_running()
+        self.remotes, self.work_remotes = zip(*[pipe_pair() for _ in range(nenvs)])
         self.ps = [
             Process(
                 target=shareworker,
-                args=(work_remote, remote, CloudpickleWrapper(env_fn)),
+                args=(
+                    work_remote,
+                    remote,
+                    CloudpickleWrapper(env_fn),
+                    worker_index if pin_workers else None,
+                    gc_interval,
+                ),
             )
-            for (work_remote, remote, env_fn) in zip(
-                self.work_remotes, self.remotes, env_fns
+            for worker_index, (work_remote, remote, env_fn) in enumerate(
+                zip(self.work_remotes, self.remotes, env_fns)
             )
         ]
         for p in self.ps:
@@ -247,56 +404,142 @@ class ShareSubprocVecEnv(ShareVecEnv):
             p.start()
         for remote in self.work_remotes:
             remote.close()
-        self.remotes[0].send(("get_num_agents", None))
+        self.remotes[0].send_bytes(COMMAND_TOKENS["get_num_agents"])
         self.n_agents = self.remotes[0].recv()
-        self.remotes[0].send(("get_spaces", None))
+        self.remotes[0].send_bytes(COMMAND_TOKENS["get_spaces"])
         observation_space, share_observation_space, action_space = self.remotes[
             0
         ].recv()
         ShareVecEnv.__init__(
             self, len(env_fns), observation_space, share_observation_space, action_space
         )
+        # numeric fields are moved into shared memory the first time they are seen,
+        # after which the workers write them in place instead of pickling them
+        self.shms = {}
+        self.shm_arrays = {}
+        self.unshared_fields = set(["infos"])
+        self.remote_index = {remote: i for i, remote in enumerate(self.remotes)}
+        self.pending_remotes = set()
+        self.step_results = [None] * nenvs
 
     def step_async(self, actions):
-        for remote, action in zip(self.remotes, actions):
-            remote.send(("step", action))
+        if isinstance(actions, torch.Tensor):
+            actions = actions.detach().cpu().numpy()
+        if "actions" not in self.shm_arrays and "actions" not in self.unshared_fields:
+            if isinstance(actions, np.ndarray) and actions.dtype.kind in "biuf":
+                self.share_fields([("actions", actions)])
+            else:
+                self.unshared_fields.add("actions")
+        shm_actions = self.shm_arrays.get("actions")
+        if shm_actions is not None and np.shape(actions) == shm_actions.shape:
+            shm_actions[...] = actions
+            for remote in self.remotes:
+                remote.send_bytes(COMMAND_TOKENS["step"])
+        else:
+            for remote, action in zip(self.remotes, actions):
+                remote.send(("step", action))
+        self.step_results = [None] * self.num_envs
+        self.pending_remotes = set(self.remotes)
         self.waiting = True
 
+    def poll_step_wait(self, timeout=None):
+        """Collect the step results that arrive within timeout seconds, in whatever
+        order the envs finish (None blocks until at least one is ready).
+        Returns the indices of the envs whose results have been received so far."""
+        if not self.pending_remotes:
+            # wait([], None) would block forever
+            return [i for i, result in enumerate(self.step_results) if result is not None]
+        for remote in wait(self.pending_remotes, timeout):
+            self.step_results[self.remote_index[remote]] = remote.recv()
+            self.pending_remotes.remove(remote)
+        return [i for i, result in enumerate(self.step_results) if result is not None]
+
     def step_wait(self):
-        results = [remote.recv() for remote in self.remotes]
+        while self.pending_remotes:
+            self.poll_step_wait()
         self.waiting = False
-        obs, share_obs, rews, dones, infos, available_actions = zip(*results)
-        return (
-            np.stack(obs),
-            np.stack(share_obs),
-            np.stack(rews),
-            np.stack(dones),
-            infos,
-            np.stack(available_actions),
-        )
+        return self.gather(self.step_results, STEP_FIELDS)
+
+    def recv_all(self):
+        """Receive one message from every remote as soon as each becomes ready."""
+        results = [None] * self.num_envs
+        pending = set(self.remotes)
+        while pending:
+            for remote in wait(pending):
+                results[self.remote_index[remote]] = remote.recv()
+                pending.remove(remote)
+        return results
 
     def reset(self):
         for remote in self.remotes:
-            remote.send(("reset", None))
-        results = [remote.recv() for remote in self.remotes]
-        obs, share_obs, available_actions = zip(*results)
-        return np.stack(obs), np.stack(share_obs), np.stack(available_actions)
+            remote.send_bytes(COMMAND_TOKENS["reset"])
+        return self.gather(self.recv_all(), RESET_FIELDS)
+
+    def gather(self, results, fields):
+        """Batch the per-env results along the first axis.
+        Fields already in shared memory are copied out of their slab (the caller
+        may hold on to them across steps), the others are stacked."""
+        batch = []
+        new_fields = []
+        for field, column in zip(fields, zip(*results)):
+            if field in self.shm_arrays:
+                slab = self.shm_arrays[field]
+                if all(value is None for value in column):
+                    batch.append(slab.copy())
+                else:  # some workers sent values their slab rows could not hold
+                    batch.append(np.stack([
+                        slab[i] if value is None else value for i, value in enumerate(column)
+                    ]))
+            elif field == "infos":
+                batch.append(column)
+            else:
+                stacked = np.stack(column)
+                if field in FIELD_DTYPES:
+                    stacked = stacked.astype(FIELD_DTYPES[field], copy=False)
+                if field not in self.unshared_fields:
+                    if stacked.dtype.kind in "biuf":
+                        new_fields.append((field, stacked))
+                    else:  # e.g. available_actions is None for continuous actions
+                        self.unshared_fields.add(field)
+                batch.append(stacked)
+        if new_fields:
+            self.share_fields(new_fields)
+        return tuple(batch)
+
+    def share_fields(self, fields):
+        """Allocate one (n_envs, ...) shared memory slab per field and let every
+        worker attach to its own row."""
+        specs = []
+        for field, stacked in fields:
+            shm = shared_memory.SharedMemory(create=True, size=max(stacked.nbytes, 1))
+            self.shms[field] = shm
+            self.shm_arrays[field] = np.ndarray(
+                stacked.shape, dtype=stacked.dtype, buffer=shm.buf
+            )
+            specs.append((field, shm.name, stacked.shape, stacked.dtype.str))
+        for index, remote in enumerate(self.remotes):
+            remote.send(("attach_shared_memory", (index, specs)))
 
     def reset_task(self):
         for remote in self.remotes:
-            remote.send(("reset_task", None))
+            remote.send_bytes(COMMAND_TOKENS["reset_task"])
         return np.stack([remote.recv() for remote in self.remotes])
 
     def close(self):
         if self.closed:
             return
         if self.waiting:
-            for remote in self.remotes:
+            for remote in self.pending_remotes:
                 remote.recv()
         for remote in self.remotes:
-            remote.send(("close", None))
+            remote.send_bytes(COMMAND_TOKENS["close"])
         for p in self.ps:
             p.join()
+        self.shm_arrays = {}
+        for shm in self.shms.values():
+            shm.close()
+            shm.unlink()
+        self.shms = {}
         self.closed = True
 
 
@@ -317,44 +560,63 @@ class ShareDummyVecEnv(ShareVecEnv):
             self.n_agents = env.n_agents
         except:
             pass
+        # (shape, dtype) of each batched field, taken from the first results and
+        # widened if a later value does not fit
+        self.layouts = {}
 
     def step_async(self, actions):
         self.actions = actions
 
+    def stack_results(self, results, fields):
+        """Batch the per-env results along the first axis by writing each env's row
+        into an array of the known layout, instead of letting np.array infer it.
+        The arrays are fresh on every call since the caller may keep them."""
+        if not all(field in self.layouts for field in fields if field != "infos"):
+            # first call: let np.array work out the layout of each field once
+            batch = []
+            for field, column in zip(fields, zip(*results)):
+                if field == "infos":
+                    batch.append(list(column))
+                else:
+                    stacked = np.array(column, dtype=FIELD_DTYPES.get(field))
+                    self.layouts[field] = (stacked.shape, stacked.dtype)
+                    batch.append(stacked)
+            return batch
+        batch = [
+            [None] * len(results) if field == "infos" else np.empty(*self.layouts[field])
+            for field in fields
+        ]
+        for i, result in enumerate(results):
+            for j, (field, value) in enumerate(zip(fields, result)):
+                stacked = batch[j]
+                if not (field == "infos" or field in FIELD_DTYPES or can_hold(stacked.dtype, value)):
+                    dtype = np.result_type(stacked.dtype, np.result_type(value))
+                    self.layouts[field] = (stacked.shape, dtype)
+                    stacked = batch[j] = stacked.astype(dtype)
+                stacked[i] = value
+        return batch
+
     def step_wait(self):
         results = [env.step(a) for (a, env) in zip(self.actions, self.envs)]
-        obs, share_obs, rews, dones, infos, available_actions = map(
-            np.array, zip(*results)
+        obs, share_obs, rews, dones, infos, available_actions = self.stack_results(
+            results, STEP_FIELDS
         )
 
-        for i, done in enumerate(dones):
-            if "bool" in done.__class__.__name__:  # done is a bool
-                if (
-                    done
-                ):  # if done, save the original obs, state, and available actions in info, and then reset
-                    infos[i][0]["original_obs"] = copy.deepcopy(obs[i])
-                    infos[i][0]["original_state"] = copy.deepcopy(share_obs[i])
-                    infos[i][0]["original_avail_actions"] = copy.deepcopy(
-                        available_actions[i]
-                    )
-                    obs[i], share_obs[i], available_actions[i] = self.envs[i].reset()
-            else:
-                if np.all(
-                    done
-                ):  # if done, save the original obs, state, and available actions in info, and then reset
-                    infos[i][0]["original_obs"] = copy.deepcopy(obs[i])
-                    infos[i][0]["original_state"] = copy.deepcopy(share_obs[i])
-                    infos[i][0]["original_avail_actions"] = copy.deepcopy(
-                        available_actions[i]
-                    )
-                    obs[i], share_obs[i], available_actions[i] = self.envs[i].reset()
+        # an env is done when its done flag (or all of its agents' done flags) is set
+        need_reset = dones.reshape(len(dones), -1).all(axis=1)
+        for i in np.flatnonzero(need_reset):
+            # save the original obs, state, and available actions in info, and then reset
+            infos[i][0]["original_obs"] = fast_copy(obs[i])
+            infos[i][0]["original_state"] = fast_copy(share_obs[i])
+            infos[i][0]["original_avail_actions"] = fast_copy(available_actions[i])
+            obs[i], share_obs[i], available_actions[i] = self.envs[i].reset()
         self.actions = None
 
         return obs, share_obs, rews, dones, infos, available_actions
 
     def reset(self):
         results = [env.reset() for env in self.envs]
-        obs, share_obs, available_actions = map(np.array, zip(*results))
+        obs, share_obs, available_actions = self.stack_results(results, RESET_FIELDS)
         return obs, share_obs, available_actions
 
     def close(self):
@@ -433,7 +695,26 @@ class IsaacLabWrapper(object):
 
         self._agent_map = {agent: i for i, agent in enumerate(self.unwrapped.agents)}
         self._agent_map_inv = {i: agent for i, agent in enumerate(self.unwrapped.agents)}
+        self._agent_list = list(self.unwrapped.agents)
         self.is_adversarial = hasattr(self.unwrapped.cfg, "teams")
+        self._teams = self.unwrapped.cfg.teams if self.is_adversarial else None
+        # output tensors of stack_padded_tensors_last_axis, the agent shapes are fixed
+        self._padded_layouts = {}
+        # reward tensors filled in place by torch.stack(..., out=...), keyed by team (None if not adversarial)
+        self._reward_bufs = {}
+
+        # (agent, action index, action size) of every agent, so that step does not
+        # rebuild the action spaces to slice the padded actions
+        if self.is_adversarial:
+            self._action_slices = [
+                (agent, self._agent_map[agent], space.shape[0])
+                for team_spaces in self.action_space.values()
+                for agent, space in team_spaces.items()
+            ]
+        else:
+            self._action_slices = [
+                (self._agent_map_inv[i], i, space.shape[0]) for i, space in self.action_space.items()
+            ]
 
         # device
         if hasattr(self.unwrapped, "device"):
@@ -452,41 +733,125 @@ class IsaacLabWrapper(object):
         :return: The attribute value
         :rtype: Any
         """
-        if hasattr(self._env, key):
+        # a single getattr per lookup, hasattr followed by getattr would resolve the attribute twice
+        try:
             return getattr(self._env, key)
-        if hasattr(self.unwrapped, key):
+        except AttributeError:
+            pass
+        try:
             return getattr(self.unwrapped, key)
+        except AttributeError:
+            pass
         raise AttributeError(f"Wrapped environment ({self.unwrapped.__class__.__name__}) does not have attribute '{key}'")
     
     def reset(self) -> Tuple[torch.Tensor, torch.Tensor, Any]:
         _obs, _ = self._env.reset()
 
+        s_obs_final = self._shared_obs(_obs)
+        return _obs, s_obs_final, None
+
+    def _shared_obs(self, _obs: Mapping[str, torch.Tensor]) -> torch.Tensor:
+        """Build the shared observation by concatenating the (flattened) observations of all agents
+
+        Every agent sees the same shared observation, so the result is a read-only expanded view
+        rather than num_agents stacked copies
+
+        :return: Shared observation of shape (num_envs, num_agents, share_obs_dim)
+        :rtype: torch.Tensor
+        """
         s_obs = []
 
         for _, observation in _obs.items():
             if len(observation.shape) > 2:
                 observation = observation.reshape(observation.shape[0], -1)
             s_obs.append(observation)
-        
+
         s_obs = torch.concat(s_obs, dim=-1)
-        s_obs_multi_agent = []
-        for _ in range(self.num_agents):
-            s_obs_multi_agent.append(s_obs)
+        return s_obs.unsqueeze(1).expand(-1, len(self._agent_list), -1)
+
+    def _stack_rewards(self, rewards: Sequence[torch.Tensor], team: Any = None) -> torch.Tensor:
+        """Stack the per-agent rewards into a tensor allocated on the first call
+
+        :param rewards: The rewards of each agent, of shape (num_envs,)
+        :type rewards: sequence of torch.Tensor
+        :param team: The team of the agents, or None to stack all the agents
+
+        :return: Rewards of shape (num_agents, num_envs) for a team, else (num_envs, num_agents, 1)
+        :rtype: torch.Tensor
+        """
+        buf = self._reward_bufs.get(team)
+        if buf is None:
+            if team is None:
+                shape = (*rewards[0].shape, len(rewards), 1)
+            else:
+                shape = (len(rewards), *rewards[0].shape)
+            # step() usually runs under torch.inference_mode(), which would make the buffer
+            # an inference tensor that later steps outside of it could not write to
+            with torch.inference_mode(False):
+                buf = torch.empty(shape, dtype=rewards[0].dtype, device=rewards[0].device)
+            self._reward_bufs[team] = buf
+        if team is None:
+            torch.stack(rewards, dim=1, out=buf[..., 0])
+        else:
+            torch.stack(rewards, out=buf)
+        return buf
+
+    def _stack_dones(self, terminated: Mapping[str, torch.Tensor], truncated: Mapping[str, torch.Tensor]) -> torch.Tensor:
+        """Stack the per-agent terminated and truncated flags with a single kernel and combine them
+
+        :return: Dones of shape (num_envs, num_agents)
+        :rtype: torch.Tensor
+        """
+        agents = self._agent_list
+        flags = torch.stack([terminated[agent] for agent in agents] + [truncated[agent] for agent in agents], dim=1)
+        # the stacked flags are ours, so OR the truncated half into the terminated half in place
+        return flags[:, :len(agents)].logical_or_(flags[:, len(agents):])
+
+    def stack_padded_tensors_last_axis(self, tensors: Sequence[torch.Tensor], key: Any = None) -> torch.Tensor:
+        """Stack tensors whose last dimension may differ, zero padding them to the largest one
+
+        The output is allocated once and each tensor is copied into its slice, instead of
+        padding every tensor separately and stacking the padded copies
+
+        :param tensors: The tensors to stack, equal in all but the last dimension
+        :type tensors: sequence of torch.Tensor
+        :param key: If given, the output tensor is allocated on the first call with this key and
+                    reused afterwards, so the shapes stacked under a key must not change. The padding
+                    is never written to and stays zero
+        :type key: Any
+
+        :return: The stacked tensor of shape (*tensors[0].shape[:-1], len(tensors), max_size)
+        :rtype: torch.Tensor
+        """
+        layout = self._padded_layouts.get(key) if key is not None else None
+        if layout is None:
+            sizes = [tensor.shape[-1] for tensor in tensors]
+            # with equal sizes (e.g. homogeneous agents) there is nothing to pad
+            homogeneous = min(sizes) == max(sizes)
+            if homogeneous and key is None:
+                return torch.stack(tensors, -2)
+            shape = list(tensors[0].shape[:-1]) + [len(tensors), max(sizes)]
+            # kept across steps, so not an inference tensor even if this step runs under inference mode
+            with torch.inference_mode(False):
+                stacked = torch.zeros(shape, dtype=tensors[0].dtype, device=tensors[0].device)
+            layout = (sizes, homogeneous, stacked)
+            if key is not None:
+                self._padded_layouts[key] = layout
+        sizes, homogeneous, stacked = layout
+        if homogeneous:
+            return torch.stack(tensors, -2, out=stacked)
+        for i, (tensor, size) in enumerate(zip(tensors, sizes)):
+            stacked[..., i, :size] = tensor
+        return stacked
 
-        s_obs_final = torch.stack(s_obs_multi_agent, dim=1)
-        return _obs, s_obs_final, None
-    
     def step_adversarial(self, actions: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, Any]:
-        _actions = {}
-        for team, agents in self.unwrapped.cfg.teams.items():
-            for agent in agents:
-                _actions[agent] = actions[self._agent_map[agent]][:,:self.action_space[team][agent].shape[0]]
+        _actions = {agent: actions[i][:, :size] for agent, i, size in self._action_slices}
         _obs, _reward, terminated, truncated, info = self._env.step(_actions)
 
         s_obs = {}
         obs = []
         reward = {}
-        for team in self.cfg.teams.keys():
+        for team in self._teams.keys():
             team_rewards = []
             team_obs = []
             for agent_obs in _obs[team].values():
@@ -496,16 +861,12 @@ class IsaacLabWrapper(object):
             for agent_reward in _reward[team].values():
                 team_rewards.append(agent_reward)
 
-            s_obs[team] = self.stack_padded_tensors_last_axis(team_obs, 0)
-            reward[team] = torch.stack(team_rewards)
+            s_obs[team] = self.stack_padded_tensors_last_axis(team_obs, key=("team", team))
+            reward[team] = self._stack_rewards(team_rewards, team)
 
-        obs = self.stack_padded_tensors_last_axis(obs, 0)
+        obs = self.stack_padded_tensors_last_axis(obs, key="obs")
 
-        terminated = torch.stack([terminated[agent] for agent in self.unwrapped.agents], axis=1)
-        truncated = torch.stack([truncated[agent] for agent in self.unwrapped.agents], axis=1)
-
-
-        dones = torch.logical_or(terminated, truncated)
+        dones = self._stack_dones(terminated, truncated)
                 
         return obs, s_obs, reward, dones, info, None
 
@@ -520,33 +881,23 @@ class IsaacLabWrapper(object):
         :return: Observation, reward, terminated, truncated, info
         :rtype: tuple of dictionaries of torch.Tensor and any other info
         """
+        # move the whole batch at once, rather than each agent's slice when the env consumes it
+        if isinstance(actions, torch.Tensor) and actions.device != self._device:
+            # only host to device copies are safe to leave asynchronous: the env
+            # could read a device to host copy before it has finished
+            actions = actions.to(self._device, non_blocking=self._device.type == "cuda")
+
         if self.is_adversarial:
             return self.step_adversarial(actions)
 
-        actions = {self._agent_map_inv[i]:actions[i][:,:self.action_space[i].shape[0]] for i in range(self.unwrapped.num_agents)}
+        actions = {agent: actions[i][:, :size] for agent, i, size in self._action_slices}
 
         _obs, reward, terminated, truncated, info = self._env.step(actions)
 
-        s_obs = []
-
-        for _, observation in _obs.items():
-            if len(observation.shape) > 2:
-                observation = observation.reshape(observation.shape[0], -1)
-            s_obs.append(observation)
-        
-        s_obs = torch.concat(s_obs, dim=-1)
-        s_obs_multi_agent = []
-        for _ in range(self.num_agents):
-            s_obs_multi_agent.append(s_obs)
-
-        s_obs_final = torch.stack(s_obs_multi_agent, dim=1)
-
-        reward = torch.stack([reward[agent] for agent in self.unwrapped.agents], axis=1)
-        reward = reward.unsqueeze(-1)
-        terminated = torch.stack([terminated[agent] for agent in self.unwrapped.agents], axis=1)
-        truncated = torch.stack([truncated[agent] for agent in self.unwrapped.agents], axis=1)
+        s_obs_final = self._shared_obs(_obs)
 
-        dones = torch.logical_or(terminated, truncated)
+        reward = self._stack_rewards([reward[agent] for agent in self._agent_list])
+        dones = self._stack_dones(terminated, truncated)
 
         return _obs, s_obs_final, reward, dones, info, None
 
@@ -643,9 +994,11 @@ class IsaacLabWrapper(object):
     #     space = self._unwrapped.state_space
     #     return {agent: space for agent in self.possible_agents}
 
-    @property
+    @functools.cached_property
     def observation_space(self) -> Mapping[int, gym.Space]:
         """Observation spaces
+
+        The spaces are fixed for the lifetime of the environment, so they are built on first access only
         """
         obs = dict()
         if self.is_adversarial:
@@ -673,7 +1026,7 @@ class IsaacLabWrapper(object):
                     )
             return obs
 
-    @property
+    @functools.cached_property
     def action_space(self) -> Mapping[int, gym.Space]:
         """Action spaces
         """
@@ -690,7 +1043,7 @@ class IsaacLabWrapper(object):
             return action_space
         return {self._agent_map[k]: gymnasium.spaces.Box(v.low.flatten()[-1],v.high.flatten()[-1],(v.shape[-1],)) for k, v in self.unwrapped.action_spaces.items()}
     
-    @property
+    @functools.cached_property
     def share_observation_space(self) -> Mapping[int, gym.Space]:
         """Share observation space
         """
@@ -730,7 +1083,10 @@ class IsaacLabWrapper(object):
 class IsaacVideoWrapper(gymnasium.wrappers.RecordVideo):
 
     def step(self, action):
-        """Steps through the environment using action, recording observations if :attr:`self.recording`."""
+        """Steps through the environment using action, starting a recording when the trigger fires.
+
+        While a recording is running this method is shadowed by :meth:`_step_recording`, so that the
+        steps taken while not recording do not check :attr:`self.recording`."""
         (
             observations,
             rewards,
@@ -742,18 +1098,40 @@ class IsaacVideoWrapper(gymnasium.wrappers.RecordVideo):
         self.step_id += 1
         self.episode_id += 1
 
-
-        if self.recording:
-            assert self.video_recorder is not None
-            self.video_recorder.capture_frame()
-            self.recorded_frames += 1
-            if self.video_length > 0:
-                if self.recorded_frames > self.video_length:
-                    self.close_video_recorder()
-                    print("end recording")
-
-        elif self._video_enabled():
+        if self._video_enabled():
             self.start_video_recorder()
             print("start recording")
 
-        return observations, rewards, terminateds, truncateds, infos
\ No newline at end of file
+        return observations, rewards, terminateds, truncateds, infos
+
+    def _step_recording(self, action):
+        """Steps through the environment using action, recording observations."""
+        (
+            observations,
+            rewards,
+            terminateds,
+            truncateds,
+            infos,
+        ) = self.env.step(action)
+
+        self.step_id += 1
+        self.episode_id += 1
+
+        assert self.video_recorder is not None
+        self.video_recorder.capture_frame()
+        self.recorded_frames += 1
+        if self.video_length > 0:
+            if self.recorded_frames > self.video_length:
+                self.close_video_recorder()
+                print("end recording")
+
+        return observations, rewards, terminateds, truncateds, infos
+
+    def start_video_recorder(self):
+        super().start_video_recorder()
+        self.step = self._step_recording
+
+    def close_video_recorder(self):
+        super().close_video_recorder()
+        # fall back to the non-recording step of the class
+        self.__dict__.pop("step", None)
@@ -1,4 +1,4 @@
-from .mujoco_multi import MujocoMulti
+from .mujoco_multi import MujocoMulti, MujocoMultiVec
 from .coupled_half_cheetah import CoupledHalfCheetah
 from .manyagent_swimmer import ManyAgentSwimmerEnv
 from .manyagent_ant import ManyAgentAntEnv
@@ -4,6 +4,7 @@ from gym.spaces import Box
 from gym.wrappers import TimeLimit
 import numpy as np
 
+from harl.envs.env_wrappers import ShareSubprocVecEnv
 from .multiagentenv import MultiAgentEnv
 from .manyagent_swimmer import ManyAgentSwimmerEnv
 from .isaaclab_ant import IsaacLabAntEnv
@@ -22,20 +23,26 @@ env_REGISTRY["isaac_factor_ant-v2"] = partial(env_fn, env=IsaacLabAntEnv)
 
 # using code from https://github.com/ikostrikov/pytorch-ddpg-naf
 class NormalizedActions(gym.ActionWrapper):
+    def __init__(self, env):
+        super().__init__(env)
+        # map [-1, 1] onto [low, high] as action * scale + bias
+        low = self.action_space.low.astype(np.float32)
+        high = self.action_space.high.astype(np.float32)
+        self._scale = (high - low) * 0.5
+        self._bias = (high + low) * 0.5
+        self._inv_scale = 1.0 / self._scale
+        self._act_out = np.empty_like(self._scale)
+
     def _action(self, action):
-        action = (action + 1) / 2
-        action *= self.action_space.high - self.action_space.low
-        action += self.action_space.low
-        return action
+        np.multiply(action, self._scale, out=self._act_out)
+        self._act_out += self._bias
+        return self._act_out
 
     def action(self, action_):
         return self._action(action_)
 
     def _reverse_action(self, action):
-        action -= self.action_space.low
-        action /= self.action_space.high - self.action_space.low
-        action = action * 2 - 1
-        return action
+        return (action - self._bias) * self._inv_scale
 
 
 class MujocoMulti(MultiAgentEnv):
@@ -52,6 +59,8 @@ class MujocoMulti(MultiAgentEnv):
 
         self.n_agents = len(self.agent_partitions)
         self.n_actions = max([len(l) for l in self.agent_partitions])
+        self._rewards_buf = np.empty((self.n_agents, 1), dtype=np.float32)
+        self._dones_buf = np.empty(self.n_agents, dtype=bool)
         self.obs_add_global_pos = kwargs["env_args"].get("obs_add_global_pos", False)
 
         self.agent_obsk = kwargs["env_args"].get(
@@ -78,16 +87,16 @@ class MujocoMulti(MultiAgentEnv):
                     self.k_categories_label = "qpos,qvel|qpos"
 
             k_split = self.k_categories_label.split("|")
-            self.k_categories = [
-                k_split[k if k < len(k_split) else -1].split(",")
+            self.k_categories = tuple(
+                tuple(k_split[k if k < len(k_split) else -1].split(","))
                 for k in range(self.agent_obsk + 1)
-            ]
+            )
 
             self.global_categories_label = kwargs["env_args"].get("global_categories")
             self.global_categories = (
-                self.global_categories_label.split(",")
+                tuple(self.global_categories_label.split(","))
                 if self.global_categories_label is not None
-                else []
+                else ()
             )
 
         if self.agent_obsk is not None:
@@ -107,9 +116,11 @@ class MujocoMulti(MultiAgentEnv):
 
         self.env_version = kwargs["env_args"].get("env_version", 2)
         if self.env_version == 2:
-            try:
+            # gym<0.24 keeps its specs under registry.env_specs, later versions in registry itself
+            gym_specs = getattr(gym.envs.registry, "env_specs", gym.envs.registry)
+            if self.scenario in gym_specs:
                 self.wrapped_env = NormalizedActions(gym.make(self.scenario))
-            except gym.error.Error:
+            else:
                 self.wrapped_env = NormalizedActions(
                     TimeLimit(
                         partial(env_REGISTRY[self.scenario], **kwargs["env_args"])(),
@@ -122,55 +133,60 @@ class MujocoMulti(MultiAgentEnv):
         self.timelimit_env._max_episode_steps = self.episode_limit
         self.env = self.timelimit_env.env
         self.timelimit_env.reset()
-        self.obs_size = self.get_obs_size()
-        self.share_obs_size = self.get_state_size()*self.n_agents
+        # observations leave the env as float32, which is what the policies consume
+        self._state_buf = np.empty(self.env._get_obs().shape, dtype=np.float32)
+        # sizes are fixed for an env, so query them once; the accessors below return these
+        if self.agent_obsk is None:
+            self.obs_size = self.get_obs_agent(0).size
+        else:
+            self.obs_size = len(self.get_obs()[0])
+            # self.obs_size = max([len(self.get_obs_agent(agent_id)) for agent_id in range(self.n_agents)])
+        self.state_size = len(self.get_state()[0])
+        self.share_obs_size = self.state_size * self.n_agents
 
         # COMPATIBILITY
         self.n = self.n_agents
         # self.observation_space = [Box(low=np.array([-10]*self.n_agents), high=np.array([10]*self.n_agents)) for _ in range(self.n_agents)]
         self.observation_space = [
-            Box(low=-10, high=10, shape=(self.obs_size,)) for _ in range(self.n_agents)
+            Box(low=-10, high=10, shape=(self.obs_size,), dtype=np.float32)
+            for _ in range(self.n_agents)
         ]
         self.share_observation_space = [
-            Box(low=-10, high=10, shape=(self.share_obs_size,))
+            Box(low=-10, high=10, shape=(self.share_obs_size,), dtype=np.float32)
             for _ in range(self.n_agents)
         ]
 
         acdims = [len(ap) for ap in self.agent_partitions]
-        self.action_space = {a:
-
-                Box(
-                    self.env.action_space.low[sum(acdims[:0]) : sum(acdims[: 1])],
-                    self.env.action_space.high[sum(acdims[:0]) : sum(acdims[: 1])],
-                )
-                for a in range(self.n_agents)
-
-        }
-        self.true_action_space = tuple(
-            [
-                Box(
-                    self.env.action_space.low[sum(acdims[:a]) : sum(acdims[: a + 1])],
-                    self.env.action_space.high[sum(acdims[:a]) : sum(acdims[: a + 1])],
-                )
-                for a in range(self.n_agents)
-            ]
-        )
+        offsets = np.concatenate([[0], np.cumsum(acdims)])
+        self._act_dims = acdims
+        self._act_offsets = offsets[:-1].tolist()
+        self._flat_action_buf = np.empty(offsets[-1], dtype=self.env.action_space.dtype)
+        low, high = self.env.action_space.low, self.env.action_space.high
+        # agents with identical bounds (e.g. the 3-dim parts of '2x3') share one Box
+        box_cache = {}
+        agent_boxes = []
+        for a in range(self.n_agents):
+            agent_low = low[offsets[a] : offsets[a + 1]]
+            agent_high = high[offsets[a] : offsets[a + 1]]
+            key = (agent_low.tobytes(), agent_high.tobytes())
+            if key not in box_cache:
+                box_cache[key] = Box(agent_low, agent_high)
+            agent_boxes.append(box_cache[key])
+        self.action_space = dict(enumerate(agent_boxes))
+        self.true_action_space = tuple(agent_boxes)
 
         pass
 
     def step(self, actions):
         # need to remove dummy actions that arise due to unequal action vector sizes across agents
-        flat_actions = np.concatenate(
-            [
-                actions[i][: self.true_action_space[i].low.shape[0]]
-                for i in range(self.n_agents)
-            ]
-        )
+        flat_actions = self._flat_action_buf
+        for i, (offset, dim) in enumerate(zip(self._act_offsets, self._act_dims)):
+            flat_actions[offset : offset + dim] = actions[i][:dim]
         obs_n, reward_n, done_n, info_n = self.wrapped_env.step(flat_actions)
         self.steps += 1
 
-        info = {}
-        info.update(info_n)
+        # the env builds a fresh info dict every step, so annotate it in place
+        info = info_n
 
         # if done_n:
         #     if self.steps < self.episode_limit:
@@ -178,21 +194,21 @@ class MujocoMulti(MultiAgentEnv):
         #     else:
         #         info["episode_limit"] = True    # the next state will not be masked out
         if done_n:
-            if self.steps < self.episode_limit:
-                # the next state will be masked out
-                info["bad_transition"] = False
-            else:
-                # the next state will not be masked out
-                info["bad_transition"] = True
+            # True when truncated by the time limit: the next state will not be masked out
+            info["bad_transition"] = self.steps >= self.episode_limit
 
         # return reward_n, done_n, info
-        rewards = [[reward_n]] * self.n_agents
-        dones = [done_n] * self.n_agents
-        infos = [info for _ in range(self.n_agents)]
+        # every agent shares the team reward and done; the vec env copies these out each step
+        rewards = self._rewards_buf
+        rewards.fill(reward_n)
+        dones = self._dones_buf
+        dones.fill(done_n)
+        infos = [info] * self.n_agents
         self.log_info = info
+        # obs_n is the env's _get_obs(), so build both observations from it
         return (
-            self.get_obs(),
-            np.concatenate([self.get_state() for _ in range(self.n_agents)], axis=1),
+            self._obs_from_state(obs_n),
+            self._share_obs_from_state(obs_n),
             rewards,
             dones,
             infos,
@@ -200,19 +216,19 @@ class MujocoMulti(MultiAgentEnv):
         )
 
     def get_obs(self):
-        """Returns all agent observat3ions in a list"""
-        state = self.env._get_obs()
-        obs_n = []
-        for a in range(self.n_agents):
-            agent_id_feats = np.zeros(self.n_agents, dtype=np.float32)
-            agent_id_feats[a] = 1.0
-            # obs_n.append(self.get_obs_agent(a))
-            # obs_n.append(np.concatenate([state, self.get_obs_agent(a), agent_id_feats]))
-            # obs_n.append(np.concatenate([self.get_obs_agent(a), agent_id_feats]))
-            # obs_i = np.concatenate([state, agent_id_feats])
-            # obs_i = (obs_i - np.mean(obs_i)) / np.std(obs_i)
-            obs_n.append(state)
-        return obs_n
+        """Returns all agent observations as a read-only (n_agents, obs_size) broadcast array"""
+        return self._obs_from_state(self.env._get_obs())
+
+    def _obs_from_state(self, state):
+        # per-agent alternatives, with agent_id_feats the one-hot id of agent a:
+        # obs_n.append(self.get_obs_agent(a))
+        # obs_n.append(np.concatenate([state, self.get_obs_agent(a), agent_id_feats]))
+        # obs_n.append(np.concatenate([self.get_obs_agent(a), agent_id_feats]))
+        # obs_i = np.concatenate([state, agent_id_feats])
+        # obs_i = (obs_i - np.mean(obs_i)) / np.std(obs_i)
+        # one (n_agents, obs_size) array; the rows are read-only views of the same state
+        state = state.astype(np.float32, copy=False)
+        return np.broadcast_to(state, (self.n_agents, state.size))
 
     def get_obs_agent(self, agent_id):
         if self.agent_obsk is None:
@@ -234,24 +250,31 @@ class MujocoMulti(MultiAgentEnv):
 
     def get_obs_size(self):
         """Returns the shape of the observation"""
-        if self.agent_obsk is None:
-            return self.get_obs_agent(0).size
-        else:
-            return len(self.get_obs()[0])
-            # return max([len(self.get_obs_agent(agent_id)) for agent_id in range(self.n_agents)])
+        return self.obs_size
 
     def get_state(self, team=None):
         # TODO: May want global states for different teams (so cannot see what the other team is communicating e.g.)
-        state = self.env._get_obs()
-        state_normed = (state - np.mean(state)) / np.std(state)
-        share_obs = []
-        for a in range(self.n_agents):
-            share_obs.append(state_normed)
-        return share_obs
+        # copy out of the reused buffer, which the next step, reset or get_state overwrites
+        return [self._normalise_state(self.env._get_obs()).copy()] * self.n_agents
+
+    def _normalise_state(self, state):
+        # per-sample (state - mean) / std in a reused buffer, without the temporaries of
+        # np.std; the epsilon keeps a constant state from turning into NaNs
+        state_normed = np.subtract(state, state.mean(), out=self._state_buf)
+        state_normed *= 1.0 / np.sqrt(
+            state_normed.dot(state_normed) / state_normed.size + 1e-8
+        )
+        return state_normed
+
+    def _share_obs_from_state(self, state):
+        # every agent shares the same normalised state, tiled once per agent; the
+        # per-agent rows are read-only views of one row, the vec env copies them out
+        row = np.tile(self._normalise_state(state), self.n_agents)
+        return np.broadcast_to(row, (self.n_agents, row.size))
 
     def get_state_size(self):
         """Returns the shape of the state"""
-        return len(self.get_state()[0])
+        return self.state_size
 
     def get_avail_actions(self):  # all actions are always available
         # return np.ones(shape=(self.n_agents, self.n_actions,))
@@ -279,8 +302,12 @@ class MujocoMulti(MultiAgentEnv):
     def reset(self, **kwargs):
         """Returns initial observations and states"""
         self.steps = 0
-        self.timelimit_env.reset()
-        return self.get_obs(), np.concatenate([self.get_state() for _ in range(self.n_agents)], axis=1), self.get_avail_actions()
+        state = self.timelimit_env.reset()  # the env's _get_obs() after reset_model()
+        return (
+            self._obs_from_state(state),
+            self._share_obs_from_state(state),
+            self.get_avail_actions(),
+        )
 
     def render(self, **kwargs):
         self.env.render(**kwargs)
@@ -303,3 +330,28 @@ class MujocoMulti(MultiAgentEnv):
             "normalise_actions": False,
         }
         return env_info
+
+
+class MujocoMultiVec(ShareSubprocVecEnv):
+    """n_envs copies of MujocoMulti stepped in parallel worker processes.
+
+    Batched step(actions) takes actions of shape (n_envs, n_agents, act_dim) and
+    returns results with a leading n_envs axis. Numeric fields (obs, share obs,
+    rewards, dones and the actions themselves) travel through shared memory
+    buffers set up by ShareSubprocVecEnv rather than being pickled per step.
+    Copy rank is seeded with seed + rank * 1000, as in make_train_env.
+    """
+
+    def __init__(self, n_envs, seed, pin_workers=False, **kwargs):
+        def get_env_fn(rank):
+            def init_env():
+                env = MujocoMulti(**kwargs)
+                env.seed(seed + rank * 1000)
+                return env
+
+            return init_env
+
+        super().__init__(
+            [get_env_fn(rank) for rank in range(n_envs)],
+            pin_workers=pin_workers,
+        )